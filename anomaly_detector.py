@@ -0,0 +1,108 @@
+import json
+import os
+from datetime import datetime
+
+
+def review_date_key(review):
+    return review['date'].isoformat() if isinstance(review['date'], datetime) else str(review['date'])
+
+
+# ========== Детектор всплесков негатива (EWMA + CUSUM) ==========
+# Состояние хранится в JSON-файле: одна запись на пару (товар, источник).
+# Отзывы приходят заново при каждом запуске, поэтому каждый учитывается один раз —
+# по дате последнего обработанного отзыва и ID отзывов с этой же датой.
+class SpikeDetector:
+    def __init__(self, state_file, alpha=0.05, cusum_k=0.15, cusum_h=4.0, min_reviews=20, peer_ratio=2.0):
+        self.state_file = state_file
+        self.alpha = alpha
+        self.cusum_k = cusum_k
+        self.cusum_h = cusum_h
+        self.min_reviews = min_reviews
+        self.peer_ratio = peer_ratio
+
+    def load(self):
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            print(f"[ERROR] Ошибка чтения состояния детектора аномалий: {e}")
+            return {}
+
+    def save(self, states):
+        tmp_path = self.state_file + '.tmp'
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(states, f, ensure_ascii=False)
+            os.replace(tmp_path, self.state_file)
+        except Exception as e:
+            print(f"[ERROR] Ошибка сохранения состояния детектора аномалий: {e}")
+
+    def update(self, states, review, is_negative, is_defect):
+        key = f"{review['product_id']}:{review['source']}"
+        state = states.setdefault(key, {
+            'product_id': review['product_id'], 'source': review['source'], 'count': 0,
+            'neg_rate': 0.0, 'defect_rate': 0.0, 'neg_cusum': 0.0, 'defect_cusum': 0.0,
+            'last_date': '', 'last_ids': [], 'peer_alerted': False,
+        })
+
+        # Без настоящей даты отзыв нельзя отличить от уже учтённого — детектор его пропускает
+        if not review.get('date_known', True):
+            return
+
+        # Учитываем только отзывы новее уже обработанных; для отзывов с той же датой,
+        # что и последний учтённый, храним их ID
+        review_date = review_date_key(review)
+        last_ids = state.setdefault('last_ids', [])
+        if review_date < state['last_date']:
+            return
+        if review_date == state['last_date']:
+            if review['id'] in last_ids:
+                return
+            last_ids.append(review['id'])
+        else:
+            state['last_date'] = review_date
+            state['last_ids'] = [review['id']]
+
+        x_neg = 1.0 if is_negative else 0.0
+        x_def = 1.0 if is_defect else 0.0
+        state['count'] += 1
+
+        if state['count'] <= self.min_reviews:
+            # Прогрев: базовый уровень — обычное среднее, CUSUM не копится
+            state['neg_rate'] += (x_neg - state['neg_rate']) / state['count']
+            state['defect_rate'] += (x_def - state['defect_rate']) / state['count']
+            return
+
+        # CUSUM считается относительно базового уровня до обновления EWMA
+        state['neg_cusum'] = max(0.0, state['neg_cusum'] + x_neg - state['neg_rate'] - self.cusum_k)
+        state['defect_cusum'] = max(0.0, state['defect_cusum'] + x_def - state['defect_rate'] - self.cusum_k)
+        state['neg_rate'] += self.alpha * (x_neg - state['neg_rate'])
+        state['defect_rate'] += self.alpha * (x_def - state['defect_rate'])
+
+    def collect(self, states):
+        alerts = []
+        ready = [s for s in states.values() if s['count'] >= self.min_reviews]
+
+        for state in ready:
+            reasons = []
+            if state['neg_cusum'] > self.cusum_h:
+                reasons.append(f"рост негатива (CUSUM {state['neg_cusum']:.1f})")
+                state['neg_cusum'] = 0.0
+            if state['defect_cusum'] > self.cusum_h:
+                reasons.append(f"рост жалоб на брак (CUSUM {state['defect_cusum']:.1f})")
+                state['defect_cusum'] = 0.0
+
+            # Сравнение с остальными отслеживаемыми товарами
+            peers = [p['neg_rate'] for p in ready if p is not state]
+            if peers:
+                peer_avg = sum(peers) / len(peers)
+                above = peer_avg > 0 and state['neg_rate'] > peer_avg * self.peer_ratio
+                if above and not state['peer_alerted']:
+                    reasons.append(f"негатив {state['neg_rate']:.0%} при {peer_avg:.0%} у остальных товаров")
+                state['peer_alerted'] = above
+
+            if reasons:
+                alerts.append(f"Товар {state['product_id']} ({state['source']}): " + "; ".join(reasons))
+        return alerts
@@ -1,7 +1,8 @@
 import os
-import requests
+import asyncio
 import hashlib
-from datetime import datetime, timedelta, date
+import json
+from datetime import datetime, timedelta, date, timezone
 from dotenv import load_dotenv
 from textblob import TextBlob
 import schedule
@@ -9,6 +10,11 @@ import time
 from telegram import Bot
 import smtplib
 from email.mime.text import MIMEText
+from concurrent.futures import ThreadPoolExecutor
+
+from request_controller import RequestController
+from anomaly_detector import SpikeDetector, review_date_key
+from crawl_journal import CrawlJournal
 
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
@@ -37,8 +43,29 @@ GDRIVE_FOLDER_ID = os.getenv('GDRIVE_FOLDER_ID')  # ID папки для заг
 # --- Ключевые слова брака/дефектов ---
 DEFECT_KEYWORDS = ['брак', 'некачественный', 'поломка', 'дефект', 'возврат']
 
-# --- Инициализация Telegram бота ---
-bot = Bot(token=TELEGRAM_BOT_TOKEN)
+# --- Детектор всплесков негатива (EWMA + CUSUM) ---
+# K — половина сдвига доли негатива, который нужно ловить (~+0.3), H — порог срабатывания.
+# При K=0.15, H=4 ложная тревога при обычной доле негатива 10–30% бывает раз в ~10–90 тыс. отзывов;
+# при прежних K=0.05, H=2 — раз в ~60–600 отзывов, т.е. почти каждый день.
+ANOMALY_STATE_FILE = os.getenv('ANOMALY_STATE_FILE', 'anomaly_state.json')
+ANOMALY_ALPHA = float(os.getenv('ANOMALY_ALPHA', '0.05'))
+ANOMALY_CUSUM_K = float(os.getenv('ANOMALY_CUSUM_K', '0.15'))
+ANOMALY_CUSUM_H = float(os.getenv('ANOMALY_CUSUM_H', '4.0'))
+ANOMALY_MIN_REVIEWS = int(os.getenv('ANOMALY_MIN_REVIEWS', '20'))
+ANOMALY_PEER_RATIO = float(os.getenv('ANOMALY_PEER_RATIO', '2.0'))
+
+# --- Ограничение нагрузки на WB: параллельность, повторы, предохранитель ---
+REQUEST_MAX_CONCURRENCY = int(os.getenv('REQUEST_MAX_CONCURRENCY', '8'))
+REQUEST_MAX_RETRIES = int(os.getenv('REQUEST_MAX_RETRIES', '5'))
+REQUEST_BREAKER_THRESHOLD = int(os.getenv('REQUEST_BREAKER_THRESHOLD', '5'))
+REQUEST_BREAKER_COOLDOWN = float(os.getenv('REQUEST_BREAKER_COOLDOWN', '120'))
+
+# --- Журнал обхода: позволяет продолжить сбор после падения или перезапуска ---
+CRAWL_JOURNAL_FILE = os.getenv('CRAWL_JOURNAL_FILE', 'crawl_journal.db')
+CRAWL_RETRY_ROUNDS = int(os.getenv('CRAWL_RETRY_ROUNDS', '2'))          # Повторы недособранных товаров в рамках запуска
+CRAWL_RETRY_DELAY = float(os.getenv('CRAWL_RETRY_DELAY', '60'))         # Пауза между повторами, сек
+CRAWL_RESUME_MINUTES = int(os.getenv('CRAWL_RESUME_MINUTES', '30'))     # Через сколько минут продолжить незавершённый обход
+ALERTED_RETENTION_DAYS = int(os.getenv('ALERTED_RETENTION_DAYS', '90'))  # Сколько дней помнить отправленные тревоги
 
 # --- Инициализация Google Drive API ---
 SCOPES = ['https://www.googleapis.com/auth/drive.file']
@@ -69,8 +96,16 @@ def upload_report_to_gdrive(file_path, folder_id=None):
         print(f"[ERROR] Ошибка загрузки файла в Google Drive: {e}")
         return None
 
+# --- Контроллер запросов к WB ---
+http_controller = RequestController(
+    max_limit=REQUEST_MAX_CONCURRENCY,
+    max_retries=REQUEST_MAX_RETRIES,
+    breaker_threshold=REQUEST_BREAKER_THRESHOLD,
+    breaker_cooldown=REQUEST_BREAKER_COOLDOWN
+)
+
 # --- Получение отзывов Wildberries (по product_id) через AJAX ---
-def get_reviews_wb(product_id, max_pages=5):
+def get_reviews_wb(product_id, max_pages=5, start_page=1, on_page=None):
     reviews = []
     headers = {
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
@@ -78,17 +113,21 @@ def get_reviews_wb(product_id, max_pages=5):
         "Accept": "application/json, text/plain, */*",
     }
 
-    for page in range(1, max_pages + 1):
+    for page in range(start_page, max_pages + 1):
         url = f"https://card.wb.ru/cards/detail?nm={product_id}&page={page}"
         try:
-            response = requests.get(url, headers=headers, timeout=10)
+            response = http_controller.get(url, headers=headers, timeout=10)
             response.raise_for_status()
             data = response.json()
 
             reviews_data = data.get('data', {}).get('orders', {}).get('data', [])
             if not reviews_data:
+                if on_page:
+                    on_page(product_id, page, [], True)
                 break
 
+            page_reviews = []
+
             for r in reviews_data:
                 text = r.get('reviewText', '').strip()
                 if not text:
@@ -96,25 +135,34 @@ def get_reviews_wb(product_id, max_pages=5):
 
                 review_id = f"wb_{product_id}_{r.get('reviewId', '')}"
                 date_str = r.get('dateCreated')
+                date_known = True
                 try:
                     review_date = datetime.fromisoformat(date_str)
                 except:
                     review_date = datetime.utcnow()
+                    date_known = False
 
-                reviews.append({
+                page_reviews.append({
                     'id': review_id,
                     'product_id': str(product_id),
                     'text': text,
                     'date': review_date,
+                    'date_known': date_known,
                     'source': 'wildberries'
                 })
+            reviews.extend(page_reviews)
 
             # Если на странице меньше 10 отзывов — возможно последний сканируемый набор
-            if len(reviews_data) < 10:
+            last_page = len(reviews_data) < 10 or page == max_pages
+            if on_page:
+                on_page(product_id, page, page_reviews, last_page)
+            if last_page:
                 break
 
         except Exception as e:
-            print(f"[ERROR] Ошибка получения отзывов товара {product_id} страница {page}: {e}")
+            # Товар не отмечается завершённым: обход продолжится с этой страницы при повторе
+            print(f"[ERROR] Ошибка получения отзывов товара {product_id} страница {page}, "
+                  f"сбор продолжится позже: {e}")
             break
 
     print(f"[INFO] Собрано {len(reviews)} отзывов для товара {product_id}")
@@ -137,11 +185,19 @@ def contains_defect(text):
 
 # --- Отправка сообщения в Telegram ---
 def send_telegram_message(message):
+    # python-telegram-bot 20 асинхронный: без await сообщение не уходит.
+    # Бот создаётся на каждую отправку — его HTTP-клиент привязан к циклу событий asyncio.run
+    async def send():
+        async with Bot(token=TELEGRAM_BOT_TOKEN) as tg_bot:
+            await tg_bot.send_message(chat_id=TELEGRAM_CHAT_ID, text=message)
+
     try:
-        bot.send_message(chat_id=TELEGRAM_CHAT_ID, text=message)
+        asyncio.run(send())
         print("[INFO] Отправлено в Telegram.")
+        return True
     except Exception as e:
         print(f"[ERROR] Ошибка отправки в Telegram: {e}")
+        return False
 
 # --- Отправка письма по email через Яндекс ---
 def send_email_report(subject, body, recipient):
@@ -168,20 +224,84 @@ PRODUCTS = [
     306927225
 ]
 
+# --- Журнал обхода (SQLite) ---
+crawl_journal = CrawlJournal(CRAWL_JOURNAL_FILE, alerted_retention_days=ALERTED_RETENTION_DAYS)
+crawl_journal.init()
+
+# --- Детектор аномалий: состояние в файле, одна запись на пару (товар, источник) ---
+anomaly_detector = SpikeDetector(
+    ANOMALY_STATE_FILE,
+    alpha=ANOMALY_ALPHA,
+    cusum_k=ANOMALY_CUSUM_K,
+    cusum_h=ANOMALY_CUSUM_H,
+    min_reviews=ANOMALY_MIN_REVIEWS,
+    peer_ratio=ANOMALY_PEER_RATIO
+)
+
 # --- Основной процесс: сбор, анализ, уведомления ---
-def process_and_collect_reviews():
-    all_reviews = []
+def process_and_collect_reviews(run_id):
     defects_found = []
+    anomaly_states = anomaly_detector.load()
 
-    for product_id in PRODUCTS:
-        reviews = get_reviews_wb(product_id)
-        for r in reviews:
-            sentiment = analyze_sentiment(r['text'])
-            r['sentiment'] = sentiment
-            all_reviews.append(r)
-            if sentiment == 'negative' and contains_defect(r['text']):
-                defects_found.append(r)
-    return all_reviews, defects_found
+    def on_page(product_id, page, page_reviews, finished):
+        crawl_journal.save_page(run_id, product_id, page, page_reviews, finished)
+
+    def crawl_product(product_id):
+        last_page, finished = progress.get(str(product_id), (0, False))
+        if not finished:
+            get_reviews_wb(product_id, start_page=last_page + 1, on_page=on_page)
+
+    # Товары, недособранные из-за ошибок, повторяются с последней сохранённой страницы
+    for round_no in range(CRAWL_RETRY_ROUNDS + 1):
+        progress = crawl_journal.progress(run_id)
+        unfinished = [p for p in PRODUCTS if not progress.get(str(p), (0, False))[1]]
+        if not unfinished:
+            break
+        if round_no:
+            print(f"[WARN] Повтор сбора для товаров {unfinished} через {CRAWL_RETRY_DELAY:.0f} с")
+            time.sleep(CRAWL_RETRY_DELAY)
+        # Товары запрашиваются параллельно, фактическую нагрузку на WB ограничивает http_controller
+        with ThreadPoolExecutor(max_workers=REQUEST_MAX_CONCURRENCY) as executor:
+            list(executor.map(crawl_product, unfinished))
+
+    progress = crawl_journal.progress(run_id)
+    unfinished = [p for p in PRODUCTS if not progress.get(str(p), (0, False))[1]]
+    finished_products = {product_id for product_id, (_, finished) in progress.items() if finished}
+
+    # Все отзывы обхода (в том числе собранные до перезапуска) берутся из журнала
+    all_reviews = crawl_journal.load_reviews(run_id)
+    newly_analyzed = []
+    # Отзывы старше срока хранения отметок о тревогах уже были отправлены раньше — не повторяем
+    alert_cutoff = datetime.utcnow() - timedelta(days=ALERTED_RETENTION_DAYS)
+
+    # WB отдаёт отзывы от новых к старым, детектору нужен хронологический порядок
+    for r in sorted(all_reviews, key=review_date_key):
+        if r['sentiment'] is None:
+            r['sentiment'] = analyze_sentiment(r['text'])
+            newly_analyzed.append(r)
+        is_defect = contains_defect(r['text'])
+        # Недособранный товар в детектор не попадает: иначе отметка последней даты уйдёт вперёд
+        # и более старые отзывы с ещё не полученных страниц будут отброшены при продолжении обхода.
+        # Повторный учёт отсекается по дате последнего обработанного отзыва
+        if r['product_id'] in finished_products:
+            anomaly_detector.update(anomaly_states, r, r['sentiment'] == 'negative', is_defect)
+        if r['sentiment'] == 'negative' and is_defect and not crawl_journal.is_alerted(r['id']):
+            review_date = r['date']
+            if isinstance(review_date, datetime) and review_date.tzinfo:
+                review_date = review_date.astimezone(timezone.utc).replace(tzinfo=None)
+            if r.get('date_known', True) and isinstance(review_date, datetime) and review_date < alert_cutoff:
+                continue
+            defects_found.append(r)
+
+    crawl_journal.save_sentiments(run_id, newly_analyzed)
+    anomalies = anomaly_detector.collect(anomaly_states)
+    anomaly_detector.save(anomaly_states)
+
+    # Одно сводное уведомление по всплескам негатива
+    if anomalies:
+        send_telegram_message("📈 Всплеск негативных отзывов!\n" + "\n".join(anomalies))
+
+    return all_reviews, defects_found, unfinished
 
 # --- Формирование текстового отчёта ---
 def generate_report(all_reviews):
@@ -202,9 +322,10 @@ def generate_report(all_reviews):
 # --- Задача ежедневной обработки ---
 def daily_job():
     print(f"[{datetime.utcnow()}] Запуск ежедневной обработки отзывов Wildberries...")
-    all_reviews, defects = process_and_collect_reviews()
+    run_id = crawl_journal.start_run()
+    all_reviews, defects, unfinished = process_and_collect_reviews(run_id)
 
-    # Отправка тревог по браку в Telegram
+    # Отправка тревог по браку в Telegram (каждый отзыв — не более одного раза)
     for d in defects:
         message = (
             f"⚠️ Жалоба на брак!\n"
@@ -213,7 +334,16 @@ def daily_job():
             f"Дата: {d['date'].strftime('%Y-%m-%d %H:%M') if isinstance(d['date'], datetime) else d['date']}\n"
             f"Текст: {d['text']}"
         )
-        send_telegram_message(message)
+        if send_telegram_message(message):
+            crawl_journal.mark_alerted(d['id'])
+
+    # Обход не завершён — отчёт откладывается, собранное остаётся в журнале
+    if unfinished:
+        print(f"[WARN] Не собраны отзывы товаров {unfinished}, обход {run_id} продолжится "
+              f"через {CRAWL_RESUME_MINUTES} мин")
+        if not schedule.get_jobs('crawl-resume'):
+            schedule.every(CRAWL_RESUME_MINUTES).minutes.do(resume_crawl_job).tag('crawl-resume')
+        return
 
     # Формирование и отправка отчёта
     report = generate_report(all_reviews)
@@ -227,6 +357,13 @@ def daily_job():
         f.write(report)
 
     upload_report_to_gdrive(filename, GDRIVE_FOLDER_ID)
+    crawl_journal.finish_run(run_id)
+
+# --- Продолжение незавершённого обхода ---
+def resume_crawl_job():
+    schedule.clear('crawl-resume')
+    daily_job()
+    return schedule.CancelJob
 
 # --- Задача еженедельного отчёта (можно просто запускать daily_job) ---
 def weekly_report():
@@ -249,6 +386,9 @@ schedule.every().day.at("10:10").do(monthly_report)  # Запускается к
 
 if __name__ == "__main__":
     print("[INFO] Запущен скрипт мониторинга и обработки отзывов Wildberries.")
+    # Обход, прерванный падением или перезапуском, продолжается сразу, а не на следующий день
+    if crawl_journal.unfinished_run():
+        daily_job()
     while True:
         schedule.run_pending()
         time.sleep(60)
@@ -1,17 +1,26 @@
 import os
-import requests
+import re
+import asyncio
+import gzip
+import json
+import threading
+from collections import OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 from dotenv import load_dotenv
 from textblob import TextBlob
 import schedule
 import time
-from datetime import datetime, timedelta
+from datetime import datetime, date, timedelta, timezone
 from telegram import Bot
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Text
+from sqlalchemy import create_engine, inspect, func, text as sql_text, Column, Integer, String, Date, DateTime, Text, Float, Boolean, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import smtplib
 from email.mime.text import MIMEText
+from urllib.parse import urlparse, parse_qs
+
+from request_controller import RequestController
 
 # ========== Загрузка переменных окружения ==========
 load_dotenv()
@@ -33,33 +42,368 @@ EMAIL_SMTP_PORT = int(os.getenv('EMAIL_SMTP_PORT', '587'))
 EMAIL_LOGIN = os.getenv('EMAIL_LOGIN')
 EMAIL_PASSWORD = os.getenv('EMAIL_PASSWORD')
 
-# ========== Инициализация Telegram бота ==========
-bot = Bot(token=TELEGRAM_BOT_TOKEN)
+# Параметры детектора всплесков негатива (EWMA + CUSUM).
+# K — половина сдвига доли негатива, который нужно ловить (~+0.3), H — порог срабатывания.
+# При K=0.15, H=4 ложная тревога при обычной доле негатива 10–30% бывает раз в ~10–90 тыс. отзывов;
+# при прежних K=0.05, H=2 — раз в ~60–600 отзывов, т.е. почти каждый день.
+ANOMALY_ALPHA = float(os.getenv('ANOMALY_ALPHA', '0.05'))
+ANOMALY_CUSUM_K = float(os.getenv('ANOMALY_CUSUM_K', '0.15'))
+ANOMALY_CUSUM_H = float(os.getenv('ANOMALY_CUSUM_H', '4.0'))
+ANOMALY_MIN_REVIEWS = int(os.getenv('ANOMALY_MIN_REVIEWS', '20'))
+ANOMALY_COMPETITOR_RATIO = float(os.getenv('ANOMALY_COMPETITOR_RATIO', '2.0'))
+
+# Кэш отчётов: размер LRU и необязательный файл для сохранения между запусками
+REPORT_CACHE_SIZE = int(os.getenv('REPORT_CACHE_SIZE', '64'))
+REPORT_CACHE_FILE = os.getenv('REPORT_CACHE_FILE')
+
+# Ограничение нагрузки на API: параллельность, повторы, предохранитель
+REQUEST_MAX_CONCURRENCY = int(os.getenv('REQUEST_MAX_CONCURRENCY', '8'))
+REQUEST_MAX_RETRIES = int(os.getenv('REQUEST_MAX_RETRIES', '5'))
+REQUEST_BREAKER_THRESHOLD = int(os.getenv('REQUEST_BREAKER_THRESHOLD', '5'))
+REQUEST_BREAKER_COOLDOWN = float(os.getenv('REQUEST_BREAKER_COOLDOWN', '120'))
+
+# Хранение отзывов: помесячные таблицы и архив старых месяцев в сжатых файлах
+REVIEWS_RETENTION_MONTHS = int(os.getenv('REVIEWS_RETENTION_MONTHS', '12'))
+REVIEWS_ARCHIVE_DIR = os.getenv('REVIEWS_ARCHIVE_DIR', 'archive')
+
+# HTTP API статистики (только чтение агрегатов)
+STATS_API_HOST = os.getenv('STATS_API_HOST', '127.0.0.1')
+STATS_API_PORT = int(os.getenv('STATS_API_PORT', '8080'))
+STATS_API_WORKERS = int(os.getenv('STATS_API_WORKERS', '4'))
+STATS_CACHE_SIZE = int(os.getenv('STATS_CACHE_SIZE', '256'))
 
 # ========== Инициализация базы данных ==========
 engine = create_engine(DATABASE_URL)
 Base = declarative_base()
 
-class Review(Base):
-    __tablename__ = 'reviews'
+class ReviewColumns:
     id = Column(Integer, primary_key=True)
     review_id = Column(String, unique=True, nullable=False)
     source = Column(String, nullable=False)
     text = Column(Text, nullable=False)
     sentiment = Column(String, nullable=False)
     date = Column(DateTime, default=datetime.utcnow)
+    product_id = Column(String)
+
+# Исходная общая таблица: новые отзывы сюда не пишутся, старые переносятся в помесячные таблицы
+class Review(ReviewColumns, Base):
+    __tablename__ = 'reviews'
+
+# Состояние детектора аномалий: одна строка на пару (товар, источник)
+class AnomalyState(Base):
+    __tablename__ = 'anomaly_state'
+    __table_args__ = (UniqueConstraint('product_id', 'source'),)
+    id = Column(Integer, primary_key=True)
+    product_id = Column(String, nullable=False)
+    source = Column(String, nullable=False)
+    count = Column(Integer, nullable=False, default=0)
+    neg_rate = Column(Float, nullable=False, default=0.0)      # EWMA доли негативных отзывов
+    defect_rate = Column(Float, nullable=False, default=0.0)   # EWMA доли жалоб на брак
+    neg_cusum = Column(Float, nullable=False, default=0.0)
+    defect_cusum = Column(Float, nullable=False, default=0.0)
+    competitor_alerted = Column(Boolean, nullable=False, default=False)
+
+# Версия данных: увеличивается с каждым сохранённым отзывом
+class DataVersion(Base):
+    __tablename__ = 'data_version'
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+# Дневные агрегаты: число отзывов по (день, товар, источник, тональность)
+class ReviewRollup(Base):
+    __tablename__ = 'review_rollup'
+    __table_args__ = (UniqueConstraint('day', 'product_id', 'source', 'sentiment'),)
+    id = Column(Integer, primary_key=True)
+    day = Column(Date, nullable=False, index=True)
+    product_id = Column(String, nullable=False)  # '' — товар неизвестен (отзывы, сохранённые до появления product_id)
+    source = Column(String, nullable=False)
+    sentiment = Column(String, nullable=False)
+    count = Column(Integer, nullable=False, default=0)
+
+# Глобальный индекс ID отзывов: дубликаты ищутся по всем месяцам и архиву, независимо от даты отзыва
+class ReviewIndex(Base):
+    __tablename__ = 'review_index'
+    id = Column(Integer, primary_key=True)
+    review_id = Column(String, unique=True, nullable=False)
+    month = Column(String, nullable=False)  # 'YYYY_MM' — таблица или архив, где лежит отзыв
 
 Base.metadata.create_all(engine)
-Session = sessionmaker(bind=engine)
+
+def ensure_product_id_column(table_name):
+    # Таблицы отзывов, созданные до появления product_id, дополняются колонкой
+    columns = {c['name'] for c in inspect(engine).get_columns(table_name)}
+    if 'product_id' not in columns:
+        with engine.begin() as conn:
+            conn.execute(sql_text(f"ALTER TABLE {table_name} ADD COLUMN product_id VARCHAR"))
+
+ensure_product_id_column(Review.__tablename__)
+# expire_on_commit=False — объекты, возвращённые из save_review_to_db, остаются читаемыми после закрытия сессии
+Session = sessionmaker(bind=engine, expire_on_commit=False)
+
+# Отдельный пул соединений для API статистики, чтобы запросы не занимали соединения сбора отзывов
+if DATABASE_URL and DATABASE_URL.startswith('sqlite'):
+    stats_engine = create_engine(DATABASE_URL)
+else:
+    stats_engine = create_engine(DATABASE_URL, pool_size=STATS_API_WORKERS, max_overflow=0, pool_pre_ping=True)
+StatsSession = sessionmaker(bind=stats_engine)
+
+# ========== Помесячные таблицы отзывов ==========
+PARTITION_NAME_RE = re.compile(r'^reviews_(\d{4})_(\d{2})$')
+partition_models = {}
+dropped_partitions = set()  # таблицы, перенесённые в архив: модель остаётся, таблица создаётся заново при необходимости
+
+def month_start(dt):
+    return dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+def add_months(dt, months):
+    years, month = divmod(dt.month - 1 + months, 12)
+    return dt.replace(year=dt.year + years, month=month + 1, day=1)
+
+def months_in_range(start_date, end_date):
+    month = month_start(start_date)
+    while month <= end_date:
+        yield month
+        month = add_months(month, 1)
+
+def partition_name(dt):
+    return f"reviews_{dt.year:04d}_{dt.month:02d}"
+
+def get_partition_model(dt):
+    name = partition_name(dt)
+    model = partition_models.get(name)
+    if model is None:
+        model = type(f"Review_{dt.year:04d}_{dt.month:02d}", (ReviewColumns, Base), {'__tablename__': name})
+        model.__table__.create(engine, checkfirst=True)
+        ensure_product_id_column(name)
+        partition_models[name] = model
+    elif name in dropped_partitions:
+        model.__table__.create(engine, checkfirst=True)
+        dropped_partitions.discard(name)
+    return model
+
+def existing_partitions():
+    partitions = []
+    for name in inspect(engine).get_table_names():
+        match = PARTITION_NAME_RE.match(name)
+        if match:
+            partitions.append(datetime(int(match.group(1)), int(match.group(2)), 1))
+    return sorted(partitions)
+
+def archive_path(dt):
+    return os.path.join(REVIEWS_ARCHIVE_DIR, partition_name(dt) + '.jsonl.gz')
+
+def read_archive(dt):
+    rows = []
+    path = archive_path(dt)
+    if not os.path.exists(path):
+        return rows
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            row = json.loads(line)
+            row_date = datetime.fromisoformat(row['date'])
+            if row_date.tzinfo:
+                row_date = row_date.astimezone(timezone.utc).replace(tzinfo=None)
+            row['date'] = row_date
+            rows.append(row)
+    return rows
+
+def index_month(dt):
+    return f"{dt.year:04d}_{dt.month:02d}"
+
+def backfill_review_index():
+    # Однократное заполнение индекса по уже сохранённым и заархивированным отзывам
+    session = Session()
+    try:
+        if session.query(ReviewIndex.id).first():
+            return
+        known = set()
+        for month in existing_partitions():
+            model = get_partition_model(month)
+            for (review_id,) in session.query(model.review_id).yield_per(1000):
+                if review_id not in known:
+                    known.add(review_id)
+                    session.add(ReviewIndex(review_id=review_id, month=index_month(month)))
+        for month in archived_months():
+            for row in read_archive(month):
+                if row['review_id'] not in known:
+                    known.add(row['review_id'])
+                    session.add(ReviewIndex(review_id=row['review_id'], month=index_month(month)))
+        session.commit()
+        if known:
+            print(f"Индекс отзывов заполнен: {len(known)}")
+    except Exception as e:
+        session.rollback()
+        print("Ошибка заполнения индекса отзывов:", e)
+    finally:
+        session.close()
+
+def archived_months():
+    months = []
+    if os.path.isdir(REVIEWS_ARCHIVE_DIR):
+        for name in os.listdir(REVIEWS_ARCHIVE_DIR):
+            match = PARTITION_NAME_RE.match(name.replace('.jsonl.gz', ''))
+            if name.endswith('.jsonl.gz') and match:
+                months.append(datetime(int(match.group(1)), int(match.group(2)), 1))
+    return sorted(months)
+
+def migrate_legacy_reviews(batch_size=1000):
+    # Перенос отзывов из общей таблицы reviews в помесячные таблицы
+    session = Session()
+    moved = 0
+    try:
+        while True:
+            batch = session.query(Review).order_by(Review.id).limit(batch_size).all()
+            if not batch:
+                break
+            for r in batch:
+                review_date = r.date or datetime.utcnow()
+                if not session.query(ReviewIndex.id).filter_by(review_id=r.review_id).first():
+                    model = get_partition_model(review_date)
+                    session.add(model(review_id=r.review_id, source=r.source, text=r.text,
+                                      sentiment=r.sentiment, date=review_date, product_id=r.product_id))
+                    session.add(ReviewIndex(review_id=r.review_id, month=index_month(review_date)))
+                    session.flush()
+                session.delete(r)
+            session.commit()
+            moved += len(batch)
+        if moved:
+            print(f"Перенесено в помесячные таблицы отзывов: {moved}")
+    except Exception as e:
+        session.rollback()
+        print("Ошибка переноса отзывов в помесячные таблицы:", e)
+    finally:
+        session.close()
+
+def archive_old_partitions():
+    # Месяцы старше срока хранения выгружаются в сжатый архив, таблица удаляется
+    cutoff = add_months(month_start(datetime.utcnow()), -REVIEWS_RETENTION_MONTHS)
+    os.makedirs(REVIEWS_ARCHIVE_DIR, exist_ok=True)
+
+    for month in existing_partitions():
+        if month >= cutoff:
+            continue
+        model = get_partition_model(month)
+        session = Session()
+        try:
+            # Если архив за месяц уже есть (отзывы пришли задним числом) — дополняем его
+            rows = {row['review_id']: row for row in read_archive(month)}
+            for r in session.query(model).yield_per(1000):
+                rows[r.review_id] = {
+                    'review_id': r.review_id,
+                    'source': r.source,
+                    'text': r.text,
+                    'sentiment': r.sentiment,
+                    'date': r.date,
+                    'product_id': r.product_id,
+                }
+
+            path = archive_path(month)
+            tmp_path = path + '.tmp'
+            with gzip.open(tmp_path, 'wt', encoding='utf-8') as f:
+                for row in rows.values():
+                    f.write(json.dumps({**row, 'date': row['date'].isoformat()}, ensure_ascii=False) + '\n')
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f"Ошибка архивации {partition_name(month)}:", e)
+            continue
+        finally:
+            session.close()
+
+        model.__table__.drop(engine)
+        dropped_partitions.add(partition_name(month))
+        print(f"Таблица {partition_name(month)} перенесена в архив {path}")
+
+def backfill_review_rollup():
+    # Однократное заполнение агрегатов по уже сохранённым отзывам.
+    # У отзывов, сохранённых до появления product_id, товар неизвестен — они учитываются с product_id=''
+    session = Session()
+    try:
+        if session.query(ReviewRollup.id).first():
+            return
+    finally:
+        session.close()
+
+    rollup_counts = Counter()
+    # Месяц, восстановленный после архивации, есть и в таблице, и в архиве — каждый отзыв считается один раз
+    seen_ids = set()
+    session = Session()
+    try:
+        for month in existing_partitions():
+            model = get_partition_model(month)
+            rows = session.query(model.review_id, model.date, model.product_id, model.source,
+                                 model.sentiment).yield_per(1000)
+            for review_id, review_date, product_id, source, sentiment in rows:
+                if review_id in seen_ids:
+                    continue
+                seen_ids.add(review_id)
+                rollup_counts[(review_date.date(), product_id or '', source, sentiment)] += 1
+    finally:
+        session.close()
+    for month in archived_months():
+        for row in read_archive(month):
+            if row['review_id'] in seen_ids:
+                continue
+            seen_ids.add(row['review_id'])
+            rollup_counts[(row['date'].date(), row.get('product_id') or '', row['source'], row['sentiment'])] += 1
+
+    if rollup_counts:
+        session = Session()
+        try:
+            for (day, product_id, source, sentiment), n in rollup_counts.items():
+                add_to_rollup(session, day, product_id, source, sentiment, n)
+            session.commit()
+            print(f"Агрегаты заполнены по {sum(rollup_counts.values())} сохранённым отзывам")
+        except Exception as e:
+            session.rollback()
+            print("Ошибка заполнения агрегатов:", e)
+        finally:
+            session.close()
+
+def count_sentiments(session, sources, start_date, end_date):
+    # Подсчёт отзывов по тональности: свежие месяцы — из таблиц, старые — из архива
+    counts = {source: {'positive': 0, 'neutral': 0, 'negative': 0} for source in sources}
+    partitions = set(existing_partitions())
+
+    for month in months_in_range(start_date, end_date):
+        if month in partitions:
+            model = get_partition_model(month)
+            rows = session.query(model.source, model.sentiment, func.count(model.id)).filter(
+                model.source.in_(sources),
+                model.date >= start_date,
+                model.date <= end_date
+            ).group_by(model.source, model.sentiment).all()
+            for source, sentiment, n in rows:
+                counts[source][sentiment] = counts[source].get(sentiment, 0) + n
+
+        archive_rows = read_archive(month)
+        live_ids = set()
+        if archive_rows and month in partitions:
+            # Месяц восстановлен после архивации — отзывы из таблицы в архиве не учитываем повторно
+            live_ids = {review_id for (review_id,) in session.query(model.review_id)}
+        for row in archive_rows:
+            if row['review_id'] in live_ids:
+                continue
+            if row['source'] in counts and start_date <= row['date'] <= end_date:
+                counts[row['source']][row['sentiment']] = counts[row['source']].get(row['sentiment'], 0) + 1
+
+    return counts
 
 # ========== Ключевые слова для выявления брака ==========
 DEFECT_KEYWORDS = ['брак', 'некачественный', 'поломка', 'дефект', 'возврат']
 
+# ========== Контроллер запросов к API ==========
+http_controller = RequestController(
+    max_limit=REQUEST_MAX_CONCURRENCY,
+    max_retries=REQUEST_MAX_RETRIES,
+    breaker_threshold=REQUEST_BREAKER_THRESHOLD,
+    breaker_cooldown=REQUEST_BREAKER_COOLDOWN
+)
+
 # ========== Получение отзывов из API маркетплейса ==========
 def get_reviews(api_url, api_key, source_name, params=None):
     headers = {'Authorization': f'Bearer {api_key}'}
     try:
-        response = requests.get(api_url, headers=headers, params=params or {}, timeout=10)
+        response = http_controller.get(api_url, headers=headers, params=params or {}, timeout=10)
         response.raise_for_status()
         data = response.json()
         # Подстройте под фактическую структуру ответа API
@@ -68,8 +412,9 @@ def get_reviews(api_url, api_key, source_name, params=None):
         for r in reviews_raw:
             reviews.append({
                 'id': str(r.get('id') or r.get('reviewId') or r.get('review_id')),  # уникальный id от API
+                'product_id': str(r.get('nmId') or r.get('productId') or r.get('product_id') or source_name),
                 'text': r.get('text') or r.get('comment') or '',
-                'date': r.get('date') or r.get('created_at') or datetime.utcnow().isoformat(),
+                'date': r.get('date') or r.get('created_at'),  # без даты — время первого получения, см. save_review_to_db
                 'source': source_name
             })
         return reviews
@@ -95,25 +440,39 @@ def contains_defect(text):
 
 # ========== Сохранение нового отзыва в БД ==========
 def save_review_to_db(review):
+    date_parsed = review.get('date')
+    if isinstance(date_parsed, str):
+        try:
+            date_parsed = datetime.fromisoformat(date_parsed)
+        except:
+            date_parsed = None
+
     session = Session()
     try:
-        exists = session.query(Review).filter_by(review_id=review['id']).first()
+        # Дубликат ищется по глобальному индексу, а не по месяцу: дата отзыва может быть неизвестна,
+        # а месяц — уже в архиве
+        exists = session.query(ReviewIndex.id).filter_by(review_id=review['id']).first()
         if not exists:
-            date_parsed = review.get('date')
-            if isinstance(date_parsed, str):
-                try:
-                    date_parsed = datetime.fromisoformat(date_parsed)
-                except:
-                    date_parsed = datetime.utcnow()
+            # Для отзыва без даты сохраняется время первого получения; повторно он отсекается индексом
+            if not isinstance(date_parsed, datetime):
+                date_parsed = datetime.utcnow()
+            model = get_partition_model(date_parsed)
+            session.add(ReviewIndex(review_id=review['id'], month=index_month(date_parsed)))
             sentiment = analyze_sentiment(review['text'])
-            db_review = Review(
+            db_review = model(
                 review_id=review['id'],
                 source=review['source'],
                 text=review['text'],
                 sentiment=sentiment,
-                date=date_parsed
+                date=date_parsed,
+                product_id=review.get('product_id')
             )
             session.add(db_review)
+            # Отзыв, индекс, дневной агрегат и состояние детектора фиксируются одной транзакцией
+            add_to_rollup(session, date_parsed.date(), review.get('product_id') or '', review['source'], sentiment)
+            update_anomaly_state(session, review.get('product_id') or review['source'], review['source'],
+                                 sentiment == 'negative', contains_defect(review['text']))
+            bump_data_version(session)
             session.commit()
             return db_review
         else:
@@ -125,8 +484,14 @@ def save_review_to_db(review):
 
 # ========== Отправка сообщений в Telegram ==========
 def send_telegram_message(message):
+    # python-telegram-bot 20 асинхронный: без await сообщение не уходит.
+    # Бот создаётся на каждую отправку — его HTTP-клиент привязан к циклу событий asyncio.run
+    async def send():
+        async with Bot(token=TELEGRAM_BOT_TOKEN) as tg_bot:
+            await tg_bot.send_message(chat_id=TELEGRAM_CHAT_ID, text=message)
+
     try:
-        bot.send_message(chat_id=TELEGRAM_CHAT_ID, text=message)
+        asyncio.run(send())
         print("Отправлено в Telegram.")
     except Exception as e:
         print(f"Ошибка отправки Telegram сообщения: {e}")
@@ -147,6 +512,126 @@ def send_email_report(subject, body, recipient):
     except Exception as e:
         print(f"Ошибка отправки email: {e}")
 
+# ========== Версия данных ==========
+def get_data_version(session):
+    row = session.query(DataVersion).filter_by(id=1).first()
+    return row.version if row else 0
+
+def bump_data_version(session):
+    # Вызывается в транзакции сохранения отзыва: закэшированные отчёты устаревают
+    # ровно тогда, когда отзыв становится виден, даже если партия прервётся на середине
+    row = session.query(DataVersion).filter_by(id=1).first()
+    if row is None:
+        row = DataVersion(id=1, version=0)
+        session.add(row)
+    row.version += 1
+
+# ========== Дневные агрегаты отзывов ==========
+def add_to_rollup(session, day, product_id, source, sentiment, n=1):
+    # Вызывается в транзакции вызывающего кода — агрегаты не расходятся с таблицами отзывов
+    row = session.query(ReviewRollup).filter_by(
+        day=day, product_id=product_id, source=source, sentiment=sentiment
+    ).first()
+    if row is None:
+        row = ReviewRollup(day=day, product_id=product_id, source=source, sentiment=sentiment, count=0)
+        session.add(row)
+    row.count += n
+
+# ========== Кэш отчётов (LRU) ==========
+def load_report_cache():
+    cache = OrderedDict()
+    if REPORT_CACHE_FILE and os.path.exists(REPORT_CACHE_FILE):
+        try:
+            with open(REPORT_CACHE_FILE, 'r', encoding='utf-8') as f:
+                for key, value in json.load(f):
+                    cache[key] = value
+        except Exception as e:
+            print("Ошибка чтения кэша отчётов:", e)
+    return cache
+
+def save_report_cache():
+    if not REPORT_CACHE_FILE:
+        return
+    tmp_path = REPORT_CACHE_FILE + '.tmp'
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(list(report_cache.items()), f, ensure_ascii=False)
+        os.replace(tmp_path, REPORT_CACHE_FILE)
+    except Exception as e:
+        print("Ошибка сохранения кэша отчётов:", e)
+
+def report_cache_key(start_date, end_date, sources, version):
+    return f"{start_date.isoformat()}|{end_date.isoformat()}|{','.join(sources)}|{version}"
+
+def report_cache_get(key):
+    report = report_cache.get(key)
+    if report is not None:
+        report_cache.move_to_end(key)
+    return report
+
+def report_cache_put(key, report):
+    report_cache[key] = report
+    report_cache.move_to_end(key)
+    while len(report_cache) > REPORT_CACHE_SIZE:
+        report_cache.popitem(last=False)
+    save_report_cache()
+
+report_cache = load_report_cache()
+
+# ========== Детектор всплесков негатива (EWMA/CUSUM) ==========
+def load_anomaly_states(session):
+    return {(s.product_id, s.source): s for s in session.query(AnomalyState).all()}
+
+def update_anomaly_state(session, product_id, source, is_negative, is_defect):
+    # Вызывается в транзакции сохранения отзыва — состояние не расходится с таблицами отзывов
+    state = session.query(AnomalyState).filter_by(product_id=product_id, source=source).first()
+    if state is None:
+        state = AnomalyState(product_id=product_id, source=source, count=0,
+                             neg_rate=0.0, defect_rate=0.0, neg_cusum=0.0, defect_cusum=0.0,
+                             competitor_alerted=False)
+        session.add(state)
+
+    x_neg = 1.0 if is_negative else 0.0
+    x_def = 1.0 if is_defect else 0.0
+    state.count += 1
+
+    if state.count <= ANOMALY_MIN_REVIEWS:
+        # Прогрев: базовый уровень — обычное среднее, CUSUM не копится
+        state.neg_rate += (x_neg - state.neg_rate) / state.count
+        state.defect_rate += (x_def - state.defect_rate) / state.count
+        return
+
+    # CUSUM считается относительно базового уровня до обновления EWMA
+    state.neg_cusum = max(0.0, state.neg_cusum + x_neg - state.neg_rate - ANOMALY_CUSUM_K)
+    state.defect_cusum = max(0.0, state.defect_cusum + x_def - state.defect_rate - ANOMALY_CUSUM_K)
+    state.neg_rate += ANOMALY_ALPHA * (x_neg - state.neg_rate)
+    state.defect_rate += ANOMALY_ALPHA * (x_def - state.defect_rate)
+
+def collect_anomalies(states):
+    alerts = []
+    competitor_rates = [s.neg_rate for s in states.values()
+                        if s.source == 'Competitors' and s.count >= ANOMALY_MIN_REVIEWS]
+    competitor_avg = sum(competitor_rates) / len(competitor_rates) if competitor_rates else None
+
+    for state in states.values():
+        if state.count < ANOMALY_MIN_REVIEWS:
+            continue
+        reasons = []
+        if state.neg_cusum > ANOMALY_CUSUM_H:
+            reasons.append(f"рост негатива (CUSUM {state.neg_cusum:.1f})")
+            state.neg_cusum = 0.0
+        if state.defect_cusum > ANOMALY_CUSUM_H:
+            reasons.append(f"рост жалоб на брак (CUSUM {state.defect_cusum:.1f})")
+            state.defect_cusum = 0.0
+        if state.source == 'STILMA' and competitor_avg:
+            above = state.neg_rate > competitor_avg * ANOMALY_COMPETITOR_RATIO
+            if above and not state.competitor_alerted:
+                reasons.append(f"негатив {state.neg_rate:.0%} при {competitor_avg:.0%} у конкурентов")
+            state.competitor_alerted = above
+        if reasons:
+            alerts.append(f"Товар {state.product_id} ({state.source}): " + "; ".join(reasons))
+    return alerts
+
 # ========== Обработка отзывов, сохранение, выявление жалоб ==========
 def process_and_store_reviews():
     stilma_reviews = get_reviews(API_URL_STILMA, API_KEY_STILMA, 'STILMA')
@@ -157,13 +642,31 @@ def process_and_store_reviews():
     # Сохранение STILMA отзывов
     for review in stilma_reviews:
         saved_review = save_review_to_db(review)
-        if saved_review and saved_review.sentiment == 'negative' and contains_defect(saved_review.text):
+        if not saved_review:
+            continue
+        if saved_review.sentiment == 'negative' and contains_defect(saved_review.text):
             defects_found.append(saved_review)
 
     # Сохранение отзывов конкурентов
     for review in competitor_reviews:
         save_review_to_db(review)
 
+    # Проверка порогов по уже сохранённым состояниям; сработавшие CUSUM сбрасываются
+    anomaly_session = Session()
+    try:
+        anomalies = collect_anomalies(load_anomaly_states(anomaly_session))
+        anomaly_session.commit()
+    except Exception as e:
+        anomaly_session.rollback()
+        anomalies = []
+        print("Ошибка обновления детектора аномалий:", e)
+    finally:
+        anomaly_session.close()
+
+    # Одно сводное уведомление по всплескам негатива
+    if anomalies:
+        send_telegram_message("📈 Всплеск негативных отзывов!\n" + "\n".join(anomalies))
+
     # Отправка жалоб на брак в Telegram
     for defect in defects_found:
         message = (
@@ -178,43 +681,48 @@ def process_and_store_reviews():
     return stilma_reviews, competitor_reviews
 
 # ========== Формирование отчёта ==========
-def generate_report(period='week'):
+REPORT_SOURCES = ('STILMA', 'Competitors')
+
+def report_period_bounds(period='week'):
+    # Конец периода округляется вверх до часа, чтобы повторные запросы попадали в кэш
+    # и при этом в отчёт входили отзывы текущего часа. В заголовке отчёта — фактическая дата
+    end_date = datetime.utcnow().replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+    if period == 'week':
+        start_date = end_date - timedelta(weeks=1)
+    elif period == 'month':
+        start_date = end_date - timedelta(days=30)
+    else:
+        start_date = end_date - timedelta(weeks=1)
+    return start_date, end_date
+
+def generate_report(period='week', start_date=None, end_date=None):
+    if start_date is None or end_date is None:
+        start_date, end_date = report_period_bounds(period)
+
     session = Session()
     try:
-        end_date = datetime.utcnow()
-        if period == 'week':
-            start_date = end_date - timedelta(weeks=1)
-        elif period == 'month':
-            start_date = end_date - timedelta(days=30)
-        else:
-            start_date = end_date - timedelta(weeks=1)
-
-        stilma_reviews = session.query(Review).filter(
-            Review.source == 'STILMA',
-            Review.date >= start_date,
-            Review.date <= end_date
-        ).all()
-        competitor_reviews = session.query(Review).filter(
-            Review.source == 'Competitors',
-            Review.date >= start_date,
-            Review.date <= end_date
-        ).all()
-
-        def summarize(reviews):
-            total = len(reviews)
-            pos = sum(r.sentiment == 'positive' for r in reviews)
-            neu = sum(r.sentiment == 'neutral' for r in reviews)
-            neg = sum(r.sentiment == 'negative' for r in reviews)
-            return total, pos, neu, neg
-
-        stilma_total, stilma_pos, stilma_neu, stilma_neg = summarize(stilma_reviews)
-        comp_total, comp_pos, comp_neu, comp_neg = summarize(competitor_reviews)
+        cache_key = report_cache_key(start_date, end_date, REPORT_SOURCES, get_data_version(session))
+        cached_report = report_cache_get(cache_key)
+        if cached_report is not None:
+            return cached_report
+
+        counts = count_sentiments(session, REPORT_SOURCES, start_date, end_date)
+
+        def summarize(source_counts):
+            pos = source_counts['positive']
+            neu = source_counts['neutral']
+            neg = source_counts['negative']
+            return sum(source_counts.values()), pos, neu, neg
+
+        stilma_total, stilma_pos, stilma_neu, stilma_neg = summarize(counts['STILMA'])
+        comp_total, comp_pos, comp_neu, comp_neg = summarize(counts['Competitors'])
 
         report = (
-            f"📅 Отчёт за период: {start_date.date()} - {end_date.date()}\n"
+            f"📅 Отчёт за период: {start_date.date()} - {min(end_date, datetime.utcnow()).date()}\n"
             f"STILMA: Всего отзывов: {stilma_total}, Позитивных: {stilma_pos}, Нейтральных: {stilma_neu}, Негативных: {stilma_neg}\n"
             f"Конкуренты: Всего отзывов: {comp_total}, Позитивных: {comp_pos}, Нейтральных: {comp_neu}, Негативных: {comp_neg}\n"
         )
+        report_cache_put(cache_key, report)
         return report
 
     except Exception as e:
@@ -223,6 +731,135 @@ def generate_report(period='week'):
     finally:
         session.close()
 
+# ========== API статистики ==========
+stats_cache = OrderedDict()
+stats_cache_lock = threading.Lock()
+stats_executor = ThreadPoolExecutor(max_workers=STATS_API_WORKERS)
+
+def query_stats(product_id, source, start_day, end_day):
+    session = StatsSession()
+    try:
+        key = (product_id, source, start_day, end_day, get_data_version(session))
+        with stats_cache_lock:
+            if key in stats_cache:
+                stats_cache.move_to_end(key)
+                return stats_cache[key]
+
+        query = session.query(ReviewRollup.sentiment, func.sum(ReviewRollup.count)).filter(
+            ReviewRollup.day >= start_day,
+            ReviewRollup.day <= end_day
+        )
+        if product_id:
+            query = query.filter(ReviewRollup.product_id == product_id)
+        if source:
+            query = query.filter(ReviewRollup.source == source)
+
+        counts = {'positive': 0, 'neutral': 0, 'negative': 0}
+        for sentiment, n in query.group_by(ReviewRollup.sentiment).all():
+            counts[sentiment] = int(n or 0)
+        result = {
+            'product': product_id,
+            'source': source,
+            'from': start_day.isoformat(),
+            'to': end_day.isoformat(),
+            'total': sum(counts.values()),
+            **counts,
+        }
+
+        if product_id:
+            # Отзывы, сохранённые до появления product_id, нельзя отнести к товару — сообщаем их число
+            unattributed = session.query(func.sum(ReviewRollup.count)).filter(
+                ReviewRollup.day >= start_day,
+                ReviewRollup.day <= end_day,
+                ReviewRollup.product_id == ''
+            )
+            if source:
+                unattributed = unattributed.filter(ReviewRollup.source == source)
+            result['unattributed'] = int(unattributed.scalar() or 0)
+            if result['unattributed']:
+                result['note'] = 'За период есть отзывы без товара, они не вошли в подсчёт по product'
+
+        with stats_cache_lock:
+            stats_cache[key] = result
+            while len(stats_cache) > STATS_CACHE_SIZE:
+                stats_cache.popitem(last=False)
+        return result
+    finally:
+        session.close()
+
+async def route_stats_request(method, target):
+    url = urlparse(target)
+    if method != 'GET':
+        return 405, {'error': 'Поддерживается только GET'}
+    if url.path != '/stats':
+        return 404, {'error': 'Неизвестный путь, используйте /stats'}
+
+    params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+    try:
+        end_day = date.fromisoformat(params['to']) if 'to' in params else datetime.utcnow().date()
+        # Границы включительные: семь дней, считая день to
+        start_day = date.fromisoformat(params['from']) if 'from' in params else end_day - timedelta(days=6)
+    except ValueError:
+        return 400, {'error': 'Даты from/to должны быть в формате YYYY-MM-DD'}
+    if start_day > end_day:
+        return 400, {'error': 'Дата from позже даты to'}
+
+    # Запрос к БД выполняется в пуле потоков, цикл событий не блокируется
+    loop = asyncio.get_running_loop()
+    result = await loop.run_in_executor(
+        stats_executor, query_stats, params.get('product'), params.get('source'), start_day, end_day
+    )
+    return 200, result
+
+async def handle_stats_connection(reader, writer):
+    reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+               408: 'Request Timeout', 500: 'Internal Server Error'}
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=10)
+        while True:
+            line = await asyncio.wait_for(reader.readline(), timeout=10)
+            if line in (b'\r\n', b'\n', b''):
+                break
+        method, target, _ = request_line.decode('latin-1').split(' ', 2)
+        status, body = await route_stats_request(method, target)
+    except ValueError:
+        status, body = 400, {'error': 'Некорректный HTTP-запрос'}
+    except asyncio.TimeoutError:
+        # Клиент не прислал запрос за отведённое время — это не ошибка сервера, в лог не пишем
+        status, body = 408, {'error': 'Время ожидания запроса истекло'}
+    except Exception as e:
+        print("Ошибка обработки запроса статистики:", e)
+        status, body = 500, {'error': 'Внутренняя ошибка'}
+
+    payload = json.dumps(body, ensure_ascii=False).encode('utf-8')
+    headers = (
+        f"HTTP/1.1 {status} {reasons[status]}\r\n"
+        f"Content-Type: application/json; charset=utf-8\r\n"
+        f"Content-Length: {len(payload)}\r\n"
+        f"Connection: close\r\n\r\n"
+    )
+    try:
+        writer.write(headers.encode('latin-1') + payload)
+        await writer.drain()
+    finally:
+        writer.close()
+
+def start_stats_api():
+    # Сервер работает в отдельном потоке рядом с планировщиком и не мешает задачам сбора
+    async def serve():
+        server = await asyncio.start_server(handle_stats_connection, STATS_API_HOST, STATS_API_PORT)
+        print(f"API статистики доступно на http://{STATS_API_HOST}:{STATS_API_PORT}/stats")
+        async with server:
+            await server.serve_forever()
+
+    def run():
+        try:
+            asyncio.run(serve())
+        except Exception as e:
+            print("Ошибка запуска API статистики:", e)
+
+    threading.Thread(target=run, name='stats-api', daemon=True).start()
+
 # ========== Ежедневная задача ==========
 def daily_job():
     print(f"[{datetime.utcnow()}] Запуск ежедневной обработки отзывов...")
@@ -242,13 +879,29 @@ def monthly_report():
     send_telegram_message(report)
     send_email_report('Ежемесячный отчёт STILMA', report, REPORT_EMAIL)
 
+def monthly_report_job():
+    # В schedule нет ежемесячного интервала — задача запускается ежедневно и срабатывает первого числа
+    if datetime.utcnow().day == 1:
+        monthly_report()
+
+# ========== Архивация старых отзывов ==========
+def retention_job():
+    print(f"[{datetime.utcnow()}] Архивация отзывов старше {REVIEWS_RETENTION_MONTHS} мес...")
+    archive_old_partitions()
+
 # ========== Планировщик ==========
+schedule.every().day.at("03:00").do(retention_job)
 schedule.every().day.at("10:00").do(daily_job)
 schedule.every().monday.at("10:05").do(weekly_report)
-schedule.every().month.at("10:10").do(monthly_report)
+schedule.every().day.at("10:10").do(monthly_report_job)
 
 if __name__ == "__main__":
     print("Запущена система анализа отзывов STILMA.")
+    backfill_review_index()
+    migrate_legacy_reviews()
+    backfill_review_rollup()
+    if STATS_API_PORT:
+        start_stats_api()
     while True:
         schedule.run_pending()
         time.sleep(60)
@@ -0,0 +1,144 @@
+import json
+import sqlite3
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from anomaly_detector import review_date_key
+
+
+# ========== Журнал обхода (SQLite) ==========
+# Хранит собранные страницы и отзывы текущего обхода, чтобы после падения или перезапуска
+# продолжить с последней сохранённой страницы, и ID отзывов, по которым уже отправлена тревога.
+class CrawlJournal:
+    def __init__(self, path, alerted_retention_days=90):
+        self.path = path
+        self.alerted_retention_days = alerted_retention_days
+
+    @contextmanager
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def init(self):
+        with self.connect() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS crawl_runs (
+                    run_id TEXT PRIMARY KEY,
+                    started_at TEXT NOT NULL,
+                    finished_at TEXT
+                );
+                CREATE TABLE IF NOT EXISTS crawl_progress (
+                    run_id TEXT NOT NULL,
+                    product_id TEXT NOT NULL,
+                    last_page INTEGER NOT NULL DEFAULT 0,
+                    finished INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (run_id, product_id)
+                );
+                CREATE TABLE IF NOT EXISTS crawl_reviews (
+                    run_id TEXT NOT NULL,
+                    review_id TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    sentiment TEXT,
+                    PRIMARY KEY (run_id, review_id)
+                );
+                CREATE TABLE IF NOT EXISTS alerted_reviews (
+                    review_id TEXT PRIMARY KEY,
+                    alerted_at TEXT NOT NULL
+                );
+            """)
+
+    def unfinished_run(self):
+        # Незавершённые обходы прошлых дней закрываются: их отзывы будут собраны заново свежим обходом
+        with self.connect() as conn:
+            rows = conn.execute(
+                "SELECT run_id, started_at FROM crawl_runs WHERE finished_at IS NULL ORDER BY started_at DESC"
+            ).fetchall()
+        today = datetime.utcnow().date().isoformat()
+        current = None
+        for row in rows:
+            if current is None and row['started_at'][:10] == today:
+                current = row['run_id']
+            else:
+                print(f"[WARN] Незавершённый обход {row['run_id']} за прошлый день закрыт без отчёта")
+                self.finish_run(row['run_id'])
+        return current
+
+    def start_run(self):
+        run_id = self.unfinished_run()
+        if run_id:
+            print(f"[INFO] Продолжаем незавершённый обход {run_id}")
+            return run_id
+        with self.connect() as conn:
+            run_id = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
+            conn.execute("INSERT INTO crawl_runs (run_id, started_at) VALUES (?, ?)",
+                         (run_id, datetime.utcnow().isoformat()))
+            return run_id
+
+    def progress(self, run_id):
+        with self.connect() as conn:
+            rows = conn.execute(
+                "SELECT product_id, last_page, finished FROM crawl_progress WHERE run_id = ?", (run_id,)
+            ).fetchall()
+        return {row['product_id']: (row['last_page'], bool(row['finished'])) for row in rows}
+
+    def save_page(self, run_id, product_id, page, page_reviews, finished):
+        # Отзывы страницы и отметка о её обработке пишутся одной транзакцией
+        with self.connect() as conn:
+            conn.executemany(
+                "INSERT OR IGNORE INTO crawl_reviews (run_id, review_id, payload) VALUES (?, ?, ?)",
+                [(run_id, r['id'], json.dumps({**r, 'date': review_date_key(r)}, ensure_ascii=False))
+                 for r in page_reviews]
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO crawl_progress (run_id, product_id, last_page, finished) VALUES (?, ?, ?, ?)",
+                (run_id, str(product_id), page, int(finished))
+            )
+
+    def load_reviews(self, run_id):
+        with self.connect() as conn:
+            rows = conn.execute(
+                "SELECT payload, sentiment FROM crawl_reviews WHERE run_id = ?", (run_id,)
+            ).fetchall()
+        reviews = []
+        for row in rows:
+            r = json.loads(row['payload'])
+            try:
+                r['date'] = datetime.fromisoformat(r['date'])
+            except:
+                pass
+            r['sentiment'] = row['sentiment']
+            reviews.append(r)
+        return reviews
+
+    def save_sentiments(self, run_id, reviews):
+        with self.connect() as conn:
+            conn.executemany(
+                "UPDATE crawl_reviews SET sentiment = ? WHERE run_id = ? AND review_id = ?",
+                [(r['sentiment'], run_id, r['id']) for r in reviews]
+            )
+
+    def is_alerted(self, review_id):
+        with self.connect() as conn:
+            return conn.execute(
+                "SELECT 1 FROM alerted_reviews WHERE review_id = ?", (review_id,)
+            ).fetchone() is not None
+
+    def mark_alerted(self, review_id):
+        with self.connect() as conn:
+            conn.execute("INSERT OR IGNORE INTO alerted_reviews (review_id, alerted_at) VALUES (?, ?)",
+                         (review_id, datetime.utcnow().isoformat()))
+
+    def finish_run(self, run_id):
+        # Собранные отзывы больше не нужны — журнал остаётся маленьким
+        alerted_cutoff = (datetime.utcnow() - timedelta(days=self.alerted_retention_days)).isoformat()
+        with self.connect() as conn:
+            conn.execute("UPDATE crawl_runs SET finished_at = ? WHERE run_id = ?",
+                         (datetime.utcnow().isoformat(), run_id))
+            conn.execute("DELETE FROM crawl_reviews WHERE run_id = ?", (run_id,))
+            conn.execute("DELETE FROM crawl_progress WHERE run_id = ?", (run_id,))
+            conn.execute("DELETE FROM alerted_reviews WHERE alerted_at < ?", (alerted_cutoff,))
@@ -0,0 +1,164 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import requests
+
+
+class CircuitOpenError(requests.RequestException):
+    pass
+
+
+# ========== Контроллер запросов к API ==========
+# AIMD-регулирование параллельности, Retry-After, повторы с экспоненциальной задержкой
+# и предохранитель (circuit breaker) — отдельно для каждого хоста.
+# 429 — это троттлинг: лимит снижается и хост ставится на паузу, но предохранитель не срабатывает.
+# Предохранитель считают только 5xx и ошибки соединения; пока он открыт, запросы ждут,
+# а после паузы пропускается один пробный запрос. Суммарно вызов ждёт предохранитель не дольше
+# breaker_max_wait (по умолчанию — одна пауза), затем получает CircuitOpenError.
+# Если Retry-After больше max_retry_after, хост ставится на паузу, а вызов сразу завершается ошибкой.
+class RequestController:
+    def __init__(self, min_limit=1, max_limit=8, max_retries=5, base_delay=1.0, max_delay=60.0,
+                 breaker_threshold=5, breaker_cooldown=120.0, breaker_max_wait=None, max_retry_after=300.0):
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.breaker_max_wait = breaker_cooldown if breaker_max_wait is None else breaker_max_wait
+        self.max_retry_after = max_retry_after
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    def _state(self, host):
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = {
+                    'cond': threading.Condition(),
+                    'limit': float(self.min_limit),
+                    'in_flight': 0,
+                    'paused_until': 0.0,
+                    'failures': 0,
+                    'open_until': 0.0,
+                    'probing': False,
+                }
+            return self.hosts[host]
+
+    def _acquire(self, state, url, budget):
+        # budget — сколько ещё вызову можно ждать открытый предохранитель.
+        # Возвращает (пробный ли это запрос, сколько времени ушло на ожидание предохранителя)
+        waited = 0.0
+        with state['cond']:
+            while True:
+                now = time.monotonic()
+                if state['open_until']:
+                    if now < state['open_until']:
+                        if waited + state['open_until'] - now > budget:
+                            raise CircuitOpenError(f"Предохранитель открыт для {url}")
+                        state['cond'].wait(state['open_until'] - now)
+                        waited += time.monotonic() - now
+                    elif state['probing']:
+                        # Пробный запрос уже отправлен — ждём его результата
+                        if waited >= budget:
+                            raise CircuitOpenError(f"Предохранитель открыт для {url}")
+                        state['cond'].wait(min(1.0, budget - waited))
+                        waited += time.monotonic() - now
+                    else:
+                        state['probing'] = True
+                        state['in_flight'] += 1
+                        return True, waited
+                elif now < state['paused_until']:
+                    state['cond'].wait(state['paused_until'] - now)
+                elif state['in_flight'] >= int(state['limit']):
+                    state['cond'].wait(1.0)
+                else:
+                    state['in_flight'] += 1
+                    return False, waited
+
+    def _release(self, state, outcome, probe=False, pause=0.0):
+        with state['cond']:
+            state['in_flight'] -= 1
+            if outcome == 'ok':
+                # Аддитивный рост: примерно +1 к лимиту за «окно» успешных запросов
+                state['limit'] = min(self.max_limit, state['limit'] + 1.0 / state['limit'])
+            else:
+                # Мультипликативное снижение при троттлинге или ошибке сервера
+                state['limit'] = max(self.min_limit, state['limit'] / 2)
+
+            if outcome == 'error':
+                state['failures'] += 1
+                if probe or state['failures'] >= self.breaker_threshold:
+                    state['open_until'] = time.monotonic() + self.breaker_cooldown
+            else:
+                # Хост отвечает (пусть даже 429) — предохранитель закрывается
+                state['failures'] = 0
+                state['open_until'] = 0.0
+            if probe:
+                state['probing'] = False
+
+            if pause:
+                state['paused_until'] = max(state['paused_until'], time.monotonic() + pause)
+            state['cond'].notify_all()
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _retry_after(self, response):
+        value = response.headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            retry_at = parsedate_to_datetime(value)
+            return max(0.0, retry_at.timestamp() - time.time())
+        except Exception:
+            return None
+
+    def request(self, method, url, **kwargs):
+        state = self._state(urlparse(url).netloc)
+        breaker_budget = self.breaker_max_wait
+        last_error = None
+
+        for attempt in range(self.max_retries + 1):
+            probe, waited = self._acquire(state, url, breaker_budget)
+            breaker_budget -= waited
+            # Слот освобождается в finally — при любом исключении, не только RequestException
+            outcome, pause = 'error', 0.0
+            try:
+                response = requests.request(method, url, **kwargs)
+                if response.status_code == 429:
+                    last_error = requests.HTTPError(f"429 для {url}", response=response)
+                    retry_after = self._retry_after(response)
+                    # Retry-After относится ко всему хосту — пауза действует для всех потоков
+                    outcome = 'throttled'
+                    pause = retry_after if retry_after is not None else self._backoff(attempt)
+                    if retry_after is not None and retry_after > self.max_retry_after:
+                        # Повтор раньше срока всё равно получил бы 429 — сдаёмся сразу
+                        break
+                    delay = 0.0
+                elif response.status_code >= 500:
+                    last_error = requests.HTTPError(f"{response.status_code} для {url}", response=response)
+                    delay = self._backoff(attempt)
+                else:
+                    outcome = 'ok'
+                    return response
+            except requests.RequestException as e:
+                last_error = e
+                delay = self._backoff(attempt)
+            finally:
+                self._release(state, outcome, probe, pause=pause)
+
+            if attempt < self.max_retries and delay:
+                time.sleep(delay)
+
+        raise last_error
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
@@ -0,0 +1,38 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def negative_if_bad(text):
+    return 'negative' if 'плохо' in text else 'positive'
+
+
+@pytest.fixture
+def scan(tmp_path, monkeypatch):
+    # Основной скрипт загружается заново для каждого теста — со своей базой SQLite и архивом
+    for name in ('sqlalchemy', 'pandas', 'dotenv', 'textblob', 'schedule', 'telegram', 'requests'):
+        pytest.importorskip(name)
+    import schedule
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv('DATABASE_URL', f"sqlite:///{tmp_path / 'reviews.db'}")
+    monkeypatch.setenv('REVIEWS_ARCHIVE_DIR', str(tmp_path / 'archive'))
+    monkeypatch.delenv('REPORT_CACHE_FILE', raising=False)
+
+    spec = importlib.util.spec_from_file_location('avto_scan_wb', os.path.join(ROOT, 'avto_scan_wb.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    module.sent_messages = []
+    monkeypatch.setattr(module, 'send_telegram_message', module.sent_messages.append)
+    monkeypatch.setattr(module, 'analyze_sentiment', negative_if_bad)
+    yield module
+
+    schedule.clear()
+    module.engine.dispose()
+    module.stats_engine.dispose()
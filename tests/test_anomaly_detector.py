@@ -0,0 +1,89 @@
+from datetime import datetime, timedelta
+
+from anomaly_detector import SpikeDetector
+
+START = datetime(2026, 1, 1)
+
+
+def make_reviews(pattern, product_id='1', start=0):
+    # pattern — строка из '+' и '-': негативный отзыв или нет, по одному в минуту
+    return [
+        ({'id': f"wb_{product_id}_{start + i}", 'product_id': product_id, 'source': 'wildberries',
+          'date': START + timedelta(minutes=start + i)}, mark == '-')
+        for i, mark in enumerate(pattern)
+    ]
+
+
+def feed(detector, states, reviews):
+    for review, is_negative in reviews:
+        detector.update(states, review, is_negative, False)
+
+
+def test_replayed_reviews_are_not_counted_twice(tmp_path):
+    detector = SpikeDetector(str(tmp_path / 'state.json'))
+    reviews = make_reviews('+++-' * 10 + '-' * 20)
+    states = {}
+    feed(detector, states, reviews)
+    before = dict(states['1:wildberries'])
+
+    # Следующий запуск получает те же отзывы вперемешку (WB отдаёт от новых к старым)
+    feed(detector, states, list(reversed(reviews)))
+    feed(detector, states, reviews)
+
+    assert states['1:wildberries'] == before
+    assert before['count'] == 60
+
+
+def test_replay_after_restart_keeps_state(tmp_path):
+    detector = SpikeDetector(str(tmp_path / 'state.json'))
+    reviews = make_reviews('+' * 30)
+    states = {}
+    feed(detector, states, reviews)
+    detector.save(states)
+
+    restored = detector.load()
+    feed(detector, restored, reviews)
+    assert restored == states
+
+
+def test_same_timestamp_reviews_are_counted_once_each(tmp_path):
+    detector = SpikeDetector(str(tmp_path / 'state.json'))
+    same_time = [({'id': f"wb_1_{i}", 'product_id': '1', 'source': 'wildberries', 'date': START}, False)
+                 for i in range(3)]
+    states = {}
+    feed(detector, states, same_time[:2])
+    feed(detector, states, same_time)
+    assert states['1:wildberries']['count'] == 3
+
+
+def test_reviews_without_date_are_skipped(tmp_path):
+    detector = SpikeDetector(str(tmp_path / 'state.json'))
+    states = {}
+    review = {'id': 'wb_1_x', 'product_id': '1', 'source': 'wildberries',
+              'date': datetime.utcnow(), 'date_known': False}
+    detector.update(states, review, True, True)
+    assert states['1:wildberries']['count'] == 0
+
+
+def test_steady_negative_rate_does_not_alert(tmp_path):
+    detector = SpikeDetector(str(tmp_path / 'state.json'))
+    states = {}
+    # 20% негатива на протяжении 5000 отзывов — обычный фон, не всплеск
+    feed(detector, states, make_reviews('++-++' * 1000))
+    assert detector.collect(states) == []
+
+
+def test_negative_burst_alerts_once(tmp_path):
+    detector = SpikeDetector(str(tmp_path / 'state.json'))
+    states = {}
+    feed(detector, states, make_reviews('++++-' * 40))
+    assert detector.collect(states) == []
+
+    burst = make_reviews('-' * 30, start=200)
+    feed(detector, states, burst)
+    alerts = detector.collect(states)
+    assert len(alerts) == 1 and 'рост негатива' in alerts[0]
+
+    # Повтор тех же отзывов не копит CUSUM заново
+    feed(detector, states, burst)
+    assert detector.collect(states) == []
@@ -0,0 +1,218 @@
+import asyncio
+from datetime import date, datetime, time, timedelta
+
+import pytest
+
+START = datetime(2026, 1, 1)
+
+
+def make_reviews(texts, source='STILMA', product_id='1', start=0):
+    return [
+        {'id': f"{source}_{start + i}", 'source': source, 'product_id': product_id, 'text': text,
+         'date': (START + timedelta(minutes=start + i)).isoformat()}
+        for i, text in enumerate(texts)
+    ]
+
+
+def serve_reviews(scan, monkeypatch, by_source):
+    monkeypatch.setattr(scan, 'get_reviews', lambda api_url, api_key, source_name, params=None:
+                        by_source.get(source_name, []))
+
+
+def anomaly_state(scan, product_id='1', source='STILMA'):
+    session = scan.Session()
+    try:
+        return session.query(scan.AnomalyState).filter_by(product_id=product_id, source=source).one()
+    finally:
+        session.close()
+
+
+def test_replayed_reviews_do_not_move_detector(scan, monkeypatch):
+    reviews = make_reviews(['хорошо'] * 25 + ['плохо'] * 5)
+    serve_reviews(scan, monkeypatch, {'STILMA': reviews})
+
+    scan.process_and_store_reviews()
+    first = anomaly_state(scan)
+    # API отдаёт те же отзывы при каждом запуске
+    scan.process_and_store_reviews()
+    second = anomaly_state(scan)
+
+    assert first.count == second.count == 30
+    assert (first.neg_rate, first.neg_cusum) == (second.neg_rate, second.neg_cusum)
+
+
+def test_detector_state_is_committed_with_review(scan, monkeypatch):
+    # Сбой после сохранения отзыва не оставляет состояние детектора отстающим от таблиц
+    def failing_collect(states):
+        raise RuntimeError('сбой')
+    monkeypatch.setattr(scan, 'collect_anomalies', failing_collect)
+    serve_reviews(scan, monkeypatch, {'STILMA': make_reviews(['хорошо'] * 3)})
+
+    scan.process_and_store_reviews()
+    assert anomaly_state(scan).count == 3
+
+
+def test_negative_burst_sends_one_alert(scan, monkeypatch):
+    baseline = make_reviews(['хорошо', 'хорошо', 'хорошо', 'хорошо', 'плохо'] * 8)
+    serve_reviews(scan, monkeypatch, {'STILMA': baseline})
+    scan.process_and_store_reviews()
+    assert not [m for m in scan.sent_messages if 'Всплеск' in m]
+
+    burst = make_reviews(['плохо'] * 30, start=len(baseline))
+    serve_reviews(scan, monkeypatch, {'STILMA': baseline + burst})
+    scan.process_and_store_reviews()
+    scan.process_and_store_reviews()
+    assert len([m for m in scan.sent_messages if 'Всплеск' in m]) == 1
+
+
+def test_report_cache_is_invalidated_by_interrupted_batch(scan, monkeypatch):
+    start, end = START, START + timedelta(days=7)
+    assert 'STILMA: Всего отзывов: 0,' in scan.generate_report(start_date=start, end_date=end)
+
+    # Партия падает после первого сохранённого отзыва
+    save = scan.save_review_to_db
+    saved = []
+    def crash_after_first(review):
+        if saved:
+            raise RuntimeError('сбой')
+        saved.append(save(review))
+        return saved[-1]
+    monkeypatch.setattr(scan, 'save_review_to_db', crash_after_first)
+    serve_reviews(scan, monkeypatch, {'STILMA': make_reviews(['хорошо', 'хорошо'])})
+    with pytest.raises(RuntimeError):
+        scan.process_and_store_reviews()
+
+    assert 'STILMA: Всего отзывов: 1,' in scan.generate_report(start_date=start, end_date=end)
+
+
+def old_month(scan):
+    # Месяц, который уже вышел за срок хранения
+    return scan.add_months(scan.month_start(datetime.utcnow()), -scan.REVIEWS_RETENTION_MONTHS - 2)
+
+
+def save_all(scan, reviews):
+    return [scan.save_review_to_db(review) for review in reviews]
+
+
+def month_report(scan, month):
+    # Кэш сбрасывается, чтобы отчёт действительно читал таблицы и архив
+    scan.report_cache.clear()
+    return scan.generate_report(start_date=month, end_date=scan.add_months(month, 1) - timedelta(seconds=1))
+
+
+def test_report_over_archived_month(scan):
+    month = old_month(scan)
+    reviews = make_reviews(['хорошо'] * 3 + ['плохо'] * 2)
+    for i, review in enumerate(reviews):
+        review['date'] = (month + timedelta(days=3, hours=i)).isoformat()
+    save_all(scan, reviews)
+    before = month_report(scan, month)
+    assert 'STILMA: Всего отзывов: 5, Позитивных: 3, Нейтральных: 0, Негативных: 2' in before
+
+    scan.archive_old_partitions()
+    assert month not in scan.existing_partitions()
+    assert month in scan.archived_months()
+    assert month_report(scan, month) == before
+
+
+def test_late_review_lands_in_archived_month(scan):
+    month = old_month(scan)
+    reviews = make_reviews(['хорошо'] * 3)
+    for review in reviews:
+        review['date'] = (month + timedelta(days=1)).isoformat()
+    save_all(scan, reviews)
+    scan.archive_old_partitions()
+
+    # Повтор уже заархивированного отзыва отсекается глобальным индексом
+    assert save_all(scan, reviews) == [None] * 3
+
+    late = make_reviews(['плохо'], start=100)[0]
+    late['date'] = (month + timedelta(days=20)).isoformat()
+    assert scan.save_review_to_db(late) is not None
+    assert month in scan.existing_partitions()
+    expected = 'STILMA: Всего отзывов: 4, Позитивных: 3, Нейтральных: 0, Негативных: 1'
+    assert expected in month_report(scan, month)
+
+    # Повторная архивация дополняет архив, а не перезаписывает его
+    scan.archive_old_partitions()
+    assert month not in scan.existing_partitions()
+    assert len(scan.read_archive(month)) == 4
+    assert expected in month_report(scan, month)
+
+
+def stats(scan, target):
+    return asyncio.run(scan.route_stats_request('GET', target))
+
+
+def test_stats_match_report_for_same_range(scan):
+    reviews = []
+    for day in range(6):
+        for source in ('STILMA', 'Competitors'):
+            batch = make_reviews(['хорошо'] * (day + 1) + ['плохо'] * (day % 3), source=source,
+                                 start=day * 100)
+            for i, review in enumerate(batch):
+                review['date'] = (START + timedelta(days=day, hours=i)).isoformat()
+            reviews += batch
+    save_all(scan, reviews)
+
+    first, last = date(2026, 1, 2), date(2026, 1, 4)
+    report = scan.generate_report(start_date=datetime.combine(first, time.min),
+                                  end_date=datetime.combine(last, time.max))
+    for source, label in (('STILMA', 'STILMA'), ('Competitors', 'Конкуренты')):
+        status, body = stats(scan, f"/stats?source={source}&from={first}&to={last}")
+        assert status == 200
+        assert (f"{label}: Всего отзывов: {body['total']}, Позитивных: {body['positive']}, "
+                f"Нейтральных: {body['neutral']}, Негативных: {body['negative']}") in report
+
+
+def test_stats_default_range_is_seven_days(scan):
+    status, body = stats(scan, '/stats?to=2026-01-10')
+    assert status == 200
+    assert (body['from'], body['to']) == ('2026-01-04', '2026-01-10')
+
+
+def test_stats_request_timeout_returns_408(scan, capsys):
+    class SilentReader:
+        async def readline(self):
+            raise asyncio.TimeoutError
+
+    class Writer:
+        def __init__(self):
+            self.data = b''
+        def write(self, data):
+            self.data += data
+        async def drain(self):
+            pass
+        def close(self):
+            pass
+
+    writer = Writer()
+    asyncio.run(scan.handle_stats_connection(SilentReader(), writer))
+    assert writer.data.startswith(b'HTTP/1.1 408 Request Timeout')
+    assert 'Ошибка' not in capsys.readouterr().out
+
+
+def test_rollup_backfill_counts_restored_month_once(scan, monkeypatch):
+    month = old_month(scan)
+    reviews = make_reviews(['хорошо', 'плохо', 'плохо'])
+    for review in reviews:
+        review['date'] = (month + timedelta(days=2)).isoformat()
+    save_all(scan, reviews)
+
+    # Архив записан, но таблица не удалена — отзывы месяца есть и там, и там
+    model = scan.get_partition_model(month)
+    def crash(*args, **kwargs):
+        raise RuntimeError('сбой')
+    monkeypatch.setattr(model.__table__, 'drop', crash)
+    with pytest.raises(RuntimeError):
+        scan.archive_old_partitions()
+    assert month in scan.existing_partitions() and month in scan.archived_months()
+
+    session = scan.Session()
+    session.query(scan.ReviewRollup).delete()
+    session.commit()
+    session.close()
+    scan.backfill_review_rollup()
+
+    status, body = stats(scan, f"/stats?from={month.date()}&to={(month + timedelta(days=27)).date()}")
+    assert (body['total'], body['negative']) == (3, 2)
@@ -0,0 +1,105 @@
+from datetime import datetime, timedelta
+
+from anomaly_detector import SpikeDetector
+from crawl_journal import CrawlJournal
+
+START = datetime(2026, 1, 1)
+
+
+def make_page(product_id, page, count=10, negative=False):
+    return [
+        {'id': f"wb_{product_id}_{page}_{i}", 'product_id': product_id, 'source': 'wildberries',
+         'text': 'брак' if negative else 'ok', 'date': START + timedelta(minutes=page * 100 + i),
+         'date_known': True}
+        for i in range(count)
+    ]
+
+
+def open_journal(tmp_path):
+    journal = CrawlJournal(str(tmp_path / 'journal.db'), alerted_retention_days=90)
+    journal.init()
+    return journal
+
+
+def test_restart_resumes_from_last_saved_page(tmp_path):
+    journal = open_journal(tmp_path)
+    run_id = journal.start_run()
+    journal.save_page(run_id, '1', 1, make_page('1', 1), False)
+    journal.save_page(run_id, '1', 2, make_page('1', 2), False)
+    journal.save_page(run_id, '2', 1, make_page('2', 1, count=3), True)
+
+    # Перезапуск процесса: новый экземпляр журнала над тем же файлом
+    restarted = open_journal(tmp_path)
+    assert restarted.unfinished_run() == run_id
+    assert restarted.start_run() == run_id
+    assert restarted.progress(run_id) == {'1': (2, False), '2': (1, True)}
+
+    reviews = restarted.load_reviews(run_id)
+    assert len(reviews) == 23
+    assert all(isinstance(r['date'], datetime) for r in reviews)
+
+    # Повторно полученная страница не дублирует отзывы
+    restarted.save_page(run_id, '1', 2, make_page('1', 2), False)
+    restarted.save_page(run_id, '1', 3, make_page('1', 3, count=4), True)
+    assert len(restarted.load_reviews(run_id)) == 27
+    assert restarted.progress(run_id)['1'] == (3, True)
+
+
+def test_stale_run_from_previous_day_is_closed(tmp_path):
+    journal = open_journal(tmp_path)
+    yesterday = datetime.utcnow() - timedelta(days=1)
+    with journal.connect() as conn:
+        conn.execute("INSERT INTO crawl_runs (run_id, started_at) VALUES (?, ?)",
+                     ('stale', yesterday.isoformat()))
+    journal.save_page('stale', '1', 1, make_page('1', 1), False)
+
+    assert journal.unfinished_run() is None
+    assert journal.load_reviews('stale') == []
+    assert journal.start_run() != 'stale'
+
+
+def test_no_realert_after_restart(tmp_path):
+    journal = open_journal(tmp_path)
+    run_id = journal.start_run()
+    page = make_page('1', 1, count=1, negative=True)
+    journal.save_page(run_id, '1', 1, page, True)
+    journal.mark_alerted(page[0]['id'])
+    journal.finish_run(run_id)
+
+    restarted = open_journal(tmp_path)
+    assert restarted.is_alerted(page[0]['id'])
+    assert restarted.unfinished_run() is None
+
+
+def test_alert_marks_expire_after_retention(tmp_path):
+    journal = open_journal(tmp_path)
+    old = (datetime.utcnow() - timedelta(days=91)).isoformat()
+    with journal.connect() as conn:
+        conn.execute("INSERT INTO alerted_reviews (review_id, alerted_at) VALUES (?, ?)", ('old', old))
+    journal.mark_alerted('recent')
+
+    journal.finish_run(journal.start_run())
+    assert not journal.is_alerted('old')
+    assert journal.is_alerted('recent')
+
+
+def test_resumed_run_does_not_repeat_spike_alert(tmp_path):
+    journal = open_journal(tmp_path)
+    detector = SpikeDetector(str(tmp_path / 'state.json'))
+    run_id = journal.start_run()
+    pages = [make_page('1', 1, count=40)] + [make_page('1', page, negative=True) for page in (2, 3)]
+    for page_no, page in enumerate(pages, start=1):
+        journal.save_page(run_id, '1', page_no, page, page_no == len(pages))
+
+    def process(journal, detector):
+        states = detector.load()
+        for r in sorted(journal.load_reviews(run_id), key=lambda r: r['date']):
+            detector.update(states, r, 'брак' in r['text'], False)
+        alerts = detector.collect(states)
+        detector.save(states)
+        return alerts
+
+    assert len(process(journal, detector)) == 1
+    # Падение до закрытия обхода: после перезапуска те же отзывы читаются из журнала снова
+    restarted = open_journal(tmp_path)
+    assert process(restarted, SpikeDetector(str(tmp_path / 'state.json'))) == []
@@ -0,0 +1,201 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+requests = pytest.importorskip('requests')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import request_controller
+from request_controller import CircuitOpenError, RequestController
+
+
+class FakeResponse:
+    def __init__(self, status_code, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+class ThrottlingStub:
+    # Локальная заглушка WB: отдаёт заданную последовательность ответов, затем 200
+    def __init__(self, script=(), delay=0.0):
+        self.script = list(script)
+        self.delay = delay
+        self.calls = []
+        self.in_flight = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, method, url, **kwargs):
+        with self.lock:
+            self.calls.append(time.monotonic())
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+            step = self.script.pop(0) if self.script else 200
+        try:
+            if self.delay:
+                time.sleep(self.delay)
+            if isinstance(step, Exception):
+                raise step
+            if isinstance(step, tuple):
+                return FakeResponse(*step)
+            return FakeResponse(step)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+def make_controller(**kwargs):
+    params = dict(max_limit=4, max_retries=5, base_delay=0.001, max_delay=0.5,
+                  breaker_threshold=5, breaker_cooldown=0.2)
+    params.update(kwargs)
+    return RequestController(**params)
+
+
+def host_state(controller):
+    return controller.hosts['wb.test']
+
+
+def test_throttling_does_not_open_breaker(monkeypatch):
+    stub = ThrottlingStub([(429, {'Retry-After': '0'})] * 5)
+    monkeypatch.setattr(request_controller.requests, 'request', stub)
+    controller = make_controller()
+
+    assert controller.get('http://wb.test/page').status_code == 200
+    assert len(stub.calls) == 6
+    assert host_state(controller)['open_until'] == 0.0
+
+    # Следующий запрос к тому же хосту уходит сразу
+    assert controller.get('http://wb.test/next').status_code == 200
+    assert len(stub.calls) == 7
+
+
+def test_retry_after_pauses_host(monkeypatch):
+    stub = ThrottlingStub([(429, {'Retry-After': '0.2'})])
+    monkeypatch.setattr(request_controller.requests, 'request', stub)
+    controller = make_controller()
+
+    assert controller.get('http://wb.test/page').status_code == 200
+    assert stub.calls[1] - stub.calls[0] >= 0.2
+
+
+def test_limit_grows_on_success_and_halves_on_throttling(monkeypatch):
+    stub = ThrottlingStub()
+    monkeypatch.setattr(request_controller.requests, 'request', stub)
+    controller = make_controller()
+
+    for _ in range(20):
+        controller.get('http://wb.test/page')
+    grown = host_state(controller)['limit']
+    assert grown > 2
+
+    stub.script = [(429, {'Retry-After': '0'})]
+    controller.get('http://wb.test/page')
+    # Одно уменьшение вдвое и один аддитивный шаг после успешного повтора
+    assert host_state(controller)['limit'] < grown / 2 + 1
+
+
+def test_concurrency_is_capped_by_limit(monkeypatch):
+    stub = ThrottlingStub(delay=0.01)
+    monkeypatch.setattr(request_controller.requests, 'request', stub)
+    controller = make_controller(max_limit=3)
+
+    threads = [threading.Thread(target=controller.get, args=('http://wb.test/page',)) for _ in range(30)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(stub.calls) == 30
+    assert stub.peak <= 3
+
+
+def test_server_errors_are_retried(monkeypatch):
+    stub = ThrottlingStub([503, requests.ConnectionError('reset'), 502])
+    monkeypatch.setattr(request_controller.requests, 'request', stub)
+    controller = make_controller()
+
+    assert controller.get('http://wb.test/page').status_code == 200
+    assert len(stub.calls) == 4
+
+
+def test_breaker_waits_and_recovers_with_probe(monkeypatch):
+    stub = ThrottlingStub([500] * 3)
+    monkeypatch.setattr(request_controller.requests, 'request', stub)
+    controller = make_controller(breaker_threshold=3, breaker_cooldown=0.3)
+
+    started = time.monotonic()
+    assert controller.get('http://wb.test/page').status_code == 200
+    # Четвёртая попытка — пробный запрос после паузы предохранителя, а не ошибка
+    assert len(stub.calls) == 4
+    assert stub.calls[3] - started >= 0.3
+    assert host_state(controller)['open_until'] == 0.0
+    assert host_state(controller)['failures'] == 0
+
+
+def test_failed_probe_reopens_breaker(monkeypatch):
+    stub = ThrottlingStub([500] * 4)
+    monkeypatch.setattr(request_controller.requests, 'request', stub)
+    controller = make_controller(breaker_threshold=3, breaker_cooldown=0.1, breaker_max_wait=1.0)
+
+    assert controller.get('http://wb.test/page').status_code == 200
+    assert len(stub.calls) == 5
+    # Между неудачным пробным запросом и следующим — ещё одна пауза предохранителя
+    assert stub.calls[4] - stub.calls[3] >= 0.1
+
+
+def test_gives_up_after_max_retries(monkeypatch):
+    stub = ThrottlingStub([503] * 10)
+    monkeypatch.setattr(request_controller.requests, 'request', stub)
+    controller = make_controller(max_retries=2, breaker_threshold=10)
+
+    with pytest.raises(requests.HTTPError):
+        controller.get('http://wb.test/page')
+    assert len(stub.calls) == 3
+
+
+def test_open_breaker_wait_is_capped_per_call(monkeypatch):
+    stub = ThrottlingStub([500] * 4)
+    monkeypatch.setattr(request_controller.requests, 'request', stub)
+    controller = make_controller(breaker_threshold=3, breaker_cooldown=0.1)
+
+    # Одна пауза на пробный запрос, после его неудачи вызов не ждёт вторую
+    with pytest.raises(CircuitOpenError):
+        controller.get('http://wb.test/page')
+    assert len(stub.calls) == 4
+    assert host_state(controller)['in_flight'] == 0
+
+    # Пока предохранитель открыт дольше допустимого ожидания, вызов завершается сразу
+    controller.breaker_max_wait = 0.0
+    started = time.monotonic()
+    with pytest.raises(CircuitOpenError):
+        controller.get('http://wb.test/page')
+    assert time.monotonic() - started < 0.05
+    assert len(stub.calls) == 4
+
+
+def test_long_retry_after_gives_up_and_pauses_host(monkeypatch):
+    stub = ThrottlingStub([(429, {'Retry-After': '3600'})])
+    monkeypatch.setattr(request_controller.requests, 'request', stub)
+    controller = make_controller(max_retry_after=60)
+
+    started = time.monotonic()
+    with pytest.raises(requests.HTTPError):
+        controller.get('http://wb.test/page')
+    assert len(stub.calls) == 1
+    # Пауза хоста — полный Retry-After, без ограничения max_delay
+    assert host_state(controller)['paused_until'] - started >= 3599
+
+
+def test_unexpected_exception_releases_slot(monkeypatch):
+    stub = ThrottlingStub([ValueError('bad url')])
+    monkeypatch.setattr(request_controller.requests, 'request', stub)
+    controller = make_controller()
+
+    with pytest.raises(ValueError):
+        controller.get('http://wb.test/page')
+    assert host_state(controller)['in_flight'] == 0
+    assert controller.get('http://wb.test/page').status_code == 200